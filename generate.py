@@ -5,13 +5,24 @@
 # headers from as many sources as possible (like man pages and
 # cppreference.com) and assembling it all into a precomputed lisp binary tree.
 
-import gzip
 import itertools
+import mmap
+from collections import defaultdict
+import multiprocessing
 import operator
 import os
 import re
 import sys
-import xml.etree.cElementTree as ET
+import zlib
+import xml.etree.ElementTree as ET
+
+
+_LINE_RE = re.compile(r'#include <(?P<inc>[^>]+)>'
+                      r'|BI? ".+ \*?(?P<func>[a-zA-Z_0-9]+)\(')
+# Bounded lookahead and an entity-free capture: no backtracking blowups
+# on pathological pages, and no post-hoc &lt; stripping.
+_HDR_RE = re.compile(br'Defined in header[^;]{0,200};\s*(?:&lt;)?([^&<]+)',
+                     re.I)
 
 
 shadows = {
@@ -41,51 +52,110 @@ shadows = {
     'wctype.h': 'cwctype',
 }
 
+_shadow_cache = {}
+
+VERBOSE = False
+
+
+def debug(msg):
+    """Per-symbol diagnostics; a build emits tens of thousands of these
+    lines, so they stay off unless --verbose is given."""
+    if VERBOSE:
+        sys.stderr.write(msg + '\n')
+
+
+def shadow_map(hdrs):
+    """Maps a set of C headers to their C++ shadow headers, memoized.
+
+    The same few header sets recur for every salvaged and merged
+    symbol, so cache the mapping per input set.
+    """
+    key = frozenset(hdrs)
+    result = _shadow_cache.get(key)
+    if result is None:
+        result = frozenset(shadows.get(hdr, hdr) for hdr in key)
+        _shadow_cache[key] = result
+    return result
+
+
+class Sym(object):
+    """One symbol from a cppreference index.
+
+    __slots__ keeps the tens of thousands of these records a fraction
+    of the size of the dicts they replace.
+    """
+
+    __slots__ = ('name', 'type', 'link', 'alias', 'header')
+
+    def __init__(self, name, type, link, alias=None):
+        self.name = name
+        self.type = type
+        self.link = link
+        self.alias = alias
+        self.header = None
+
 
 def make_happy_list(out, syms):
     """Outputs a list that gets turned into a btree by emacs."""
     syms.sort(key=operator.itemgetter(0))
+    lines = [('("%s" . "%s")\n' % (name, hdrs) if isinstance(hdrs, str)
+              else '("%s" %s)\n' % (name, " ".join(hdrs)))
+             for name, hdrs in syms]
     out.write('(setq includeme! \'(\n')
-    for name, hdrs in syms:
-        if isinstance(hdrs, basestring):
-            out.write('("%s" . "%s")\n' % (name, hdrs))
-        else:
-            out.write('("%s" %s)\n' % (name, " ".join(hdrs)))
+    out.writelines(lines)
     out.write('))\n')
 
 
+def gunzip(path):
+    """Decompresses a whole gzipped file in one shot.
+
+    Going through raw zlib (wbits=47 makes it accept the gzip framing)
+    is several times faster than the gzip module's file object for the
+    small files man pages tend to be.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return zlib.decompress(data, 47).decode('utf-8', 'replace')
+
+
 def get_mans(level=3, root='/usr/share/man'):
-    """Yields ``(abs-path, file-obj)`` for each man in root."""
+    """Yields the absolute path of each man page in root."""
     root = os.path.join(root, 'man%d' % (level))
     for name in os.listdir(root):
         path = os.path.join(root, name)
-        if path.endswith('.%d.gz' % (level)):
-            yield (path, gzip.open(path))
-        elif path.endswith('.%d' % (level)):
-            yield (path, open(path))
+        if (path.endswith('.%d.gz' % (level)) or
+            path.endswith('.%d' % (level))):
+            yield path
+
+
+def parse_one_man(path):
+    """Parses a single man page; module-level so Pool can pickle it."""
+    if path.endswith('.gz'):
+        text = gunzip(path)
+    else:
+        with open(path, errors='replace') as f:
+            text = f.read()
+    return list(parse_man(path, text.splitlines()))
 
 
 def parse_man(path, text):
     """Reads raw man page text and yields ``(func-name, [headers])`` pairs."""
     includes = set()
     for line in text:
-        if line.startswith('.B ') or line.startswith('.BR "#inc'):
-            m = re.search('#include <(.*?)>', line)
-            if m:
-                includes.add(m.group(1))
-        if line.startswith('.BR "#inc'):
-            m = re.search('#include <(.*?)>', line)
-            if m:
-                includes.add(m.group(1))
-        if line.startswith('.B'):
-            m = re.search(r'BI? ".+ \*?([a-zA-Z_0-9]+)\(', line)
-            if m:
-                func = m.group(1)
-                if not includes:
-                    print >>sys.stderr, "no includes for", func, "in", path
+        if line[:2] == '.B':
+            # One combined scan decides whether the line carries an
+            # include, a prototype, or neither.
+            for m in _LINE_RE.finditer(line):
+                if m.group('inc') is not None:
+                    includes.add(m.group('inc'))
                     continue
-                yield func, set(includes)
-        if 'DESCRIPTION' in line:
+                func = m.group('func')
+                if not includes:
+                    debug('no includes for %s in %s' % (func, path))
+                else:
+                    yield func, set(includes)
+                break
+        if line[:3] == '.SH' and 'DESCRIPTION' in line:
             break
 
 
@@ -94,131 +164,170 @@ def main(cppdir):
     xml_cpp_index = '%s/index-functions-cpp.xml' % (cppdir)
     htmldir = '%s/reference/en.cppreference.com/w' % (cppdir)
 
-    links = {}
+    links = defaultdict(list)
     c_syms = {}
     cpp_syms = {}
     man_syms = {}
 
     # Load information about (assumedly) C functions in man 2/3 pages.
-    for path, text in itertools.chain(get_mans(3), get_mans(2)):
-        for func, includes in parse_man(path, text):
+    # Every page is independent, so fan the gzip+regex work out across
+    # all cores and only merge the results here.  Ordered imap keeps
+    # the first-wins merge deterministic (man3 before man2), so the
+    # generated indexes don't churn between runs.
+    paths = list(itertools.chain(get_mans(3), get_mans(2)))
+    pool = multiprocessing.Pool()
+    for pairs in pool.imap(parse_one_man, paths, chunksize=64):
+        for func, includes in pairs:
             if func in man_syms:
                 if includes != man_syms[func]:
-                    print >>sys.stderr, 'does %s have %r or %r?' % (
-                        func, man_syms[func], includes)
+                    debug('does %s have %r or %r?' % (
+                        func, man_syms[func], includes))
                 continue
             man_syms[func] = includes
+    pool.close()
+    pool.join()
 
-    # C: Load all the symbols.
-    for child in ET.parse(xml_c_index).getroot():
+    # C: Load all the symbols.  iterparse + clear keeps the whole index
+    # from being materialized as a DOM just to walk it once.
+    for event, child in ET.iterparse(xml_c_index, events=('end',)):
+        name = child.attrib.get('name')
+        link = child.attrib.get('link')
+        tag = child.tag
+        child.clear()
         # Math functions seem to be having a hard time.
-        if 'link' not in child.attrib:
+        if link is None:
             continue
-        if '/' not in child.attrib['link']:
+        if '/' not in link:
             continue
-        if child.attrib['link'].startswith('cpp/'):
+        if link.startswith('cpp/'):
             continue
         # aghhh!@
-        if '(' in child.attrib['name']:
+        if '(' in name:
             continue
-        sym = {'name': child.attrib['name'],
-               'type': child.tag,
-               'link': child.attrib['link']}
-        c_syms[sym['name']] = sym
-        links.setdefault(sym['link'], []).append(sym)
+        sym = Sym(name, tag, link)
+        c_syms[sym.name] = sym
+        links[sym.link].append(sym)
 
     # C++: Load all the symbols.
-    for child in ET.parse(xml_cpp_index).getroot():
+    for event, child in ET.iterparse(xml_cpp_index, events=('end',)):
+        name = child.attrib.get('name')
+        link = child.attrib.get('link')
+        alias = child.attrib.get('alias')
+        tag = child.tag
+        child.clear()
+        if name is None:  # the root element has no attributes
+            continue
         # aghhh!@
-        if '(' in child.attrib['name']:
+        if '(' in name:
             continue
-        sym = {'name': child.attrib['name'],
-               'type': child.tag,
-               'alias': child.attrib.get('alias'),
-               'link': child.attrib.get('link')}
-        cpp_syms[sym['name']] = sym
+        sym = Sym(name, tag, link, alias)
+        cpp_syms[sym.name] = sym
 
-    # C++: Second pass to resolve typedef aliases.
+    # C++: Second pass to resolve typedef aliases and construct
+    # backlinks in one sweep over the table.
     for sym in cpp_syms.values():
-        if not sym['alias']:
-            continue
-        other = cpp_syms[sym['alias']]
-        sym['type'] = '%s(%s)' % (sym['type'], other['type'])
-        sym['link'] = other['link']
+        if sym.alias:
+            other = cpp_syms[sym.alias]
+            sym.type = '%s(%s)' % (sym.type, other.type)
+            sym.link = other.link
+        links[sym.link].append(sym)
 
-    # C++: Third pass to construct backlinks.
-    for sym in cpp_syms.values():
-        links.setdefault(sym['link'], []).append(sym)
+    # Enumerate the html tree once up front; stat()ing a candidate page
+    # per link costs a syscall for every symbol.
+    have_html = set()
+    for dirpath, dirnames, filenames in os.walk(htmldir):
+        rel = os.path.relpath(dirpath, htmldir)
+        for filename in filenames:
+            if filename.endswith('.html'):
+                if rel == '.':
+                    have_html.add(filename[:-5])
+                else:
+                    have_html.add('%s/%s' % (rel, filename[:-5]))
 
     # Figure out what headers contain all these symbols.
     for link, syms in links.items():
         htmlfile = '%s/%s.html' % (htmldir, link)
-        if not os.path.exists(htmlfile):
-            print >>sys.stderr, 'missing html:', htmlfile
+        if link not in have_html:
+            debug('missing html: %s' % (htmlfile))
             continue
-        html = open(htmlfile).read()
-        m = re.search(r'Defined in header.+?;(.+?)&', html, re.I)
-        if m:
-            header = m.group(1)
-            # fenv.h goofiness workaround :\
-            header = header.replace('&lt;', '')
+        # mmap the page so the kernel only faults in what the search
+        # touches; the marker sits near the top of every page, so find
+        # it first and only run the regex over a small window instead
+        # of the whole blob.
+        header = None
+        with open(htmlfile, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                mm = None
+            if mm is not None:
+                idx = mm.find(b'Defined in header')
+                if idx >= 0:
+                    m = _HDR_RE.search(mm, idx, idx + 512)
+                    if m:
+                        header = m.group(1).decode()
+                mm.close()
+        if header is not None:
             for sym in syms:
-                sym['header'] = header
+                sym.header = header
         else:
-            print >>sys.stderr, 'no header found:', htmlfile
+            debug('no header found: %s' % (htmlfile))
+
+    # Only man symbols that mention a shadowed header can ever be
+    # salvaged, so carve that subset out once instead of intersecting
+    # per symbol below.
+    shadow_keys = frozenset(shadows)
+    man_syms_shadowed = {
+        name: hdrs for name, hdrs in man_syms.items()
+        if not hdrs.isdisjoint(shadow_keys)}
 
     # Simplify down to `symbol: set(header)` and get rid of symbols for which
     # no header was found.
     def filter_syms(lang, syms):
         for name, sym in syms.items():
-            if sym.get('header'):
-                yield name, set([sym['header']])
+            if sym.header:
+                yield name, set([sym.header])
             else:
                 # Salvage some symbols where html page missing ugh.
                 if (name.startswith('std::') and
                     name[5:] in c_syms and
-                    c_syms[name[5:]] & set(shadows.keys())):
-                    hdrs = set(shadows.get(hdr, hdr)
-                               for hdr in c_syms[name[5:]])
-                    print >>sys.stderr, \
-                        'salvaging %s -> %s (from c)' % (name, hdrs)
+                    not c_syms[name[5:]].isdisjoint(shadow_keys)):
+                    hdrs = shadow_map(c_syms[name[5:]])
+                    debug('salvaging %s -> %s (from c)' % (name, hdrs))
                     yield (name, hdrs)
                 elif (name.startswith('std::') and
-                      name[5:] in man_syms and
-                      man_syms[name[5:]] & set(shadows.keys())):
-                    hdrs = set(shadows.get(hdr, hdr)
-                               for hdr in man_syms[name[5:]])
-                    print >>sys.stderr, \
-                        'salvaging %s -> %s (from man)' % (name, hdrs)
+                      name[5:] in man_syms_shadowed):
+                    hdrs = shadow_map(man_syms_shadowed[name[5:]])
+                    debug('salvaging %s -> %s (from man)' % (name, hdrs))
                     yield (name, hdrs)
                 else:
-                    print >>sys.stderr, 'discard %s symbol: %s' % (lang, name)
+                    debug('discard %s symbol: %s' % (lang, name))
     c_syms = dict(filter_syms('C', c_syms))
     cpp_syms = dict(filter_syms('C++', cpp_syms))
 
     # Display some countage.
-    print "len(c_syms) =", len(c_syms)
-    print "len(cpp_syms) =", len(cpp_syms)
-    print "len(man_syms) =", len(man_syms)
+    print("len(c_syms) =", len(c_syms))
+    print("len(cpp_syms) =", len(cpp_syms))
+    print("len(man_syms) =", len(man_syms))
 
     # Merge man symbols into C/C++ symbol indexes.
     for name, hdrs in man_syms.items():
         if name not in c_syms:
             c_syms[name] = hdrs
         if name not in cpp_syms and 'std::' + name not in cpp_syms:
-            cpp_syms[name] = set(shadows.get(hdr, hdr) for hdr in hdrs)
+            cpp_syms[name] = shadow_map(hdrs)
 
-    # Decanonicalize the C++ symbol index.
-    for name, hdrs in cpp_syms.items()[:]:
+    # Decanonicalize the C++ symbol index.  Snapshot just the keys; the
+    # values were never used and copying them doubled the garbage.
+    for name in list(cpp_syms):
         try:
             short_name = name[name.rindex('::') + 2:]
         except ValueError:
-            pass
+            continue
+        if short_name in cpp_syms:
+            debug('conflict %s' % (name))
         else:
-            if short_name in cpp_syms:
-                print >>sys.stderr, 'conflict', name
-            else:
-                cpp_syms[short_name] = name
+            cpp_syms[short_name] = name
 
     # Manual adjustments to annoying problems.
     cpp_syms['std::cin'] = ['iostream']
@@ -233,8 +342,16 @@ def main(cppdir):
     # Output a data structure for emacs.
     for name, syms in [('includeme-index-c', c_syms),
                        ('includeme-index-cpp', cpp_syms)]:
-        out = open(name + '.el', 'w')
-        make_happy_list(out, syms.items())
+        with open(name + '.el', 'w', 262144) as out:
+            make_happy_list(out, list(syms.items()))
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    args = sys.argv[1:]
+    if '--verbose' in args:
+        args.remove('--verbose')
+        VERBOSE = True
+        # Batch the diagnostics; a write() per line is what makes
+        # verbose runs crawl on a terminal.
+        sys.stderr = open(sys.stderr.fileno(), 'w', buffering=65536,
+                          closefd=False)
+    main(*args)